@@ -1,18 +1,29 @@
 #!/usr/bin/python3 -u
 
+import atexit
+import hashlib
+import io
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import signal
+import socket
+import subprocess
 import sys
+import threading
 import time
-import struct
 from typing import Tuple, Any
 from configparser import ConfigParser
 from argparse import ArgumentParser, Namespace
-from collections.abc import Mapping
 from pathlib import Path
 from attiny_i2c import ATTiny
 #from attiny_i2c_new import ATTiny
 
+_log = logging.getLogger()
+
 ### Global configuration of the daemon. You should know what you do if you change
 ### these values.
 
@@ -22,10 +33,10 @@ minor = 13
 patch = 1
 
 # config file is in the same directory as the script:
-_configfile_default = str(Path(__file__).parent.absolute()) + "/attiny_daemon.cfg"
-_shutdown_cmd = "sudo systemctl poweroff"  # sudo allows us to start as user 'pi'
-_reboot_cmd  = "sudo systemctl reboot"     # sudo allows us to start as user 'pi'
-_time_const  = 1.0 # used as a pause between i2c communications, the ATTiny is slow
+_configfile_default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "attiny_daemon.cfg")
+_shutdown_cmd = ["sudo", "systemctl", "poweroff"]  # sudo allows us to start as user 'pi'
+_reboot_cmd  = ["sudo", "systemctl", "reboot"]     # sudo allows us to start as user 'pi'
+_time_const  = 1.0 # maximum back-off between i2c retries, the ATTiny is slow
 _num_retries = 10  # the number of retries when reading from or writing to the ATTiny
 
 # These are the different values reported back by the ATTiny depending on its config
@@ -43,14 +54,29 @@ shutdown_levels = {
 }
 # Here we store the button functions that are called depending on the configuration
 button_functions = {
-    "nothing": lambda: logging.info("Button pressed. Configured to do nothing."),
-    "shutdown": lambda: os.system(_shutdown_cmd),
-    "reboot": lambda: os.system(_reboot_cmd)
+    "nothing": lambda: _log.info("Button pressed. Configured to do nothing."),
+    "shutdown": lambda: subprocess.run(_shutdown_cmd, check=False),
+    "reboot": lambda: subprocess.run(_reboot_cmd, check=False)
 }
 
 # this is the minimum reboot time we assume the RPi needs, used for a warning message
 minimum_boot_time = 30
 
+# with a firmware providing the status register (ATTiny.STATUS_BLOCK_VERSION) the
+# daemon hands the last status read from the ATTiny to local clients like the MQTT
+# script, so they need no i2c transfers of their own
+_status_socket = "/run/attiny_daemon/status.sock"
+
+# poll interval used while the ATTiny reports a level other than normal,
+# doubled with every poll afterwards until we are back at the sleeptime
+fast_poll_interval = 1.0
+
+# set by the signal handler to wake up the main loop, terminate tells it to stop
+# and reload to re-read the config file
+_wakeup = threading.Event()
+_terminate = threading.Event()
+_reload = threading.Event()
+
 ### Code starts here.
 ### Here be dragons...
 
@@ -63,75 +89,219 @@ def main(*args):
 
     config = Config(args.cfgfile)
     config.read_config()
+    button_function = get_button_function(config[Config.BUTTON_FUNCTION])
+    # the log level only changes with the config, no need to ask the logger in every loop
+    debug_enabled = _log.isEnabledFor(logging.DEBUG)
 
-    logging.info("ATTiny Daemon version " + str(major) + "." + str(minor) + "." + str(patch))
+    _log.info("ATTiny Daemon version %s.%s.%s", major, minor, patch)
 
-    attiny = ATTiny(config[Config.I2C_BUS], config[Config.I2C_ADDRESS], _time_const, _num_retries)
-
-    if attiny.get_last_access() < 0:
-        logging.error("Cannot access ATTiny")
-        exit(1)
+    attiny = ATTiny(config[Config.I2C_BUS], config[Config.I2C_ADDRESS], _time_const, _num_retries,
+                    config[Config.I2C_FREQUENCY])
 
+    # reading the version doubles as the check that we can access the ATTiny
     (a_major, a_minor, a_patch) = attiny.get_version()
-    logging.info("ATTiny firmware version " + str(a_major) + "." + str(a_minor) + "." + str(a_patch))
+    if a_major == 0xFFFF:
+        _log.error("Cannot access ATTiny")
+        sys.exit(1)
+    _log.info("ATTiny firmware version %s.%s.%s", a_major, a_minor, a_patch)
 
     if major != a_major:
-        logging.error("Daemon and Firmware major version mismatch. This might lead to serious problems. Check both versions.")
+        _log.error("Daemon and Firmware major version mismatch. This might lead to serious problems. Check both versions.")
+
+    # newer firmware lets us poll should_shutdown together with the other status values
+    status_snapshot = None  # (status values, time.monotonic() of the read)
+    has_status_block = (a_major, a_minor, a_patch) >= attiny.STATUS_BLOCK_VERSION
+    if has_status_block:
+        read_status = attiny.get_status_block
+        start_status_server(_status_socket, lambda: status_snapshot)
+    else:
+        read_status = lambda: (attiny.should_shutdown(),)
 
     config.merge_and_sync_values(attiny)
 
-    logging.info("Merging completed")
+    _log.info("Merging completed")
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGHUP, handle_signal)
+
+    # if systemd supervises us with WatchdogSec we ping it twice per interval, otherwise
+    # the watchdog does not limit the sleep
+    watchdog_usec = int(os.environ.get("WATCHDOG_USEC", 0))
+    watchdog_interval = watchdog_usec / 2000000 if watchdog_usec else sys.maxsize
+
+    sd_notify("READY=1\nSTATUS=Configuration merged, polling the ATTiny")
 
     # loop until stopped or error
     fast_exit = False
     set_unprimed = False
+    # bound once instead of looked up in every poll, refreshed when the config is reloaded
+    max_sleeptime = min(config[Config.SLEEPTIME], watchdog_interval)
+    poll_interval = max_sleeptime
+    wait_for_wakeup = _wakeup.wait
     try:
         while True:
-            should_shutdown = attiny.should_shutdown()
+            status = read_status()
+            should_shutdown = status[0]
             if should_shutdown == 0xFFFF:
                 # We have a big problem
-                logging.error("Lost connection to ATTiny.")
+                _log.error("Lost connection to ATTiny.")
                 # disable to fasten restart
                 # set_unprimed = True        # we still try to reset primed
                 fast_exit = True
-                exit(1)  # executes finally clause and lets the system restart the daemon
-
-            if should_shutdown > SL_INITIATED:
-                # we will not exit the process but wait for the systemd to shut us down
-                # using SIGTERM. This does not execute the finally clause and leaves
-                # everything as it is currently configured
-                global shutdown_levels
-                fallback = "Unknown shutdown_level " + str(should_shutdown) + ". Shutting down."
-                logging.warning(shutdown_levels.get(should_shutdown, fallback))
-
-                if should_shutdown > 16:
-                    attiny.set_should_shutdown(SL_INITIATED) # we are shutting down
-                    logging.info("shutting down now...")
-                    os.system(_shutdown_cmd)
-                elif (should_shutdown | button_level) != 0:
-                    # we are executing the button command and setting the level to normal
-                    attiny.set_should_shutdown(0)
-                    button_functions[config[Config.BUTTON_FUNCTION]]()
-
-            logging.debug("Sleeping for " + str(config[Config.SLEEPTIME]) + " seconds.")
-            time.sleep(config[Config.SLEEPTIME])
+                sys.exit(1)  # executes finally clause and lets the system restart the daemon
+
+            if has_status_block:
+                status_snapshot = ({
+                    "should_shutdown": should_shutdown,
+                    "battery_voltage": status[2],
+                    "external_voltage": status[3],
+                    "temperature": status[4]
+                }, time.monotonic())
+
+            sd_notify("WATCHDOG=1\nSTATUS=Polling the ATTiny, should_shutdown is %d" % should_shutdown)
+
+            sleeptime = max_sleeptime
+            # 0 is the normal case, everything else needs a closer look
+            if should_shutdown:
+                if should_shutdown > SL_INITIATED:
+                    # we will not exit the process but wait for the systemd to shut us down
+                    # using SIGTERM. This skips the cleanup in the finally clause and leaves
+                    # everything as it is currently configured
+                    message = shutdown_levels.get(should_shutdown)
+                    if message is None:
+                        _log.warning("Unknown shutdown_level %s. Shutting down.", should_shutdown)
+                    else:
+                        _log.warning(message)
+
+                    if should_shutdown > 16:
+                        attiny.set_should_shutdown(SL_INITIATED) # we are shutting down
+                        _log.info("shutting down now...")
+                        subprocess.run(_shutdown_cmd, check=False)
+                    elif should_shutdown & button_level:
+                        # we are executing the button command and setting the level to normal
+                        attiny.set_should_shutdown(0)
+                        button_function()
+
+                # poll faster while something is going on, unless we are already shutting down
+                if not should_shutdown & SL_INITIATED:
+                    poll_interval = fast_poll_interval
+
+            # afterwards back off to the configured sleeptime again, the jitter keeps us
+            # from polling in lockstep with other periodic users of the bus
+            if poll_interval < sleeptime:
+                sleeptime = min(poll_interval * random.uniform(1.0, 1.25), sleeptime)
+                poll_interval *= 2
+
+            if debug_enabled:
+                _log.debug("Sleeping for %.1f seconds.", sleeptime)
+            if wait_for_wakeup(timeout=sleeptime):
+                _wakeup.clear()
+                if _terminate.is_set():
+                    _log.info("Received SIGTERM, terminating daemon")
+                    sd_notify("STOPPING=1")
+                    fast_exit = True
+                    break
+                if _reload.is_set():
+                    _reload.clear()
+                    _log.info("Received SIGHUP, reloading the config file")
+                    sd_notify("RELOADING=1")
+                    config.read_config()
+                    config.merge_and_sync_values(attiny)
+                    button_function = get_button_function(config[Config.BUTTON_FUNCTION])
+                    max_sleeptime = min(config[Config.SLEEPTIME], watchdog_interval)
+                    debug_enabled = _log.isEnabledFor(logging.DEBUG)
+                    sd_notify("READY=1")
 
     except KeyboardInterrupt:
-        logging.info("Terminating daemon: cleaning up and exiting")
+        _log.info("Terminating daemon: cleaning up and exiting")
         # Ctrl-C means we do not run as daemon
         set_unprimed = True
     except Exception as e:
-        logging.error("An exception occurred: '" + str(e) + "' Exiting...")
+        _log.error("An exception occurred: '%s' Exiting...", e)
     finally:
-        if fast_exit == False:
+        if not fast_exit:
             # will not be executed on SIGTERM, leaving primed set to the config value
             primed = config[Config.PRIMED]
             if args.nodaemon or set_unprimed:
                 primed = False
-            if primed == False:
-                logging.info("Trying to reset primed flag")
-                attiny.set_primed(primed)
-            del attiny
+            if not primed:
+                _log.info("Trying to reset primed flag")
+                attiny.set_primed(primed, verify=True)
+        attiny.close()
+
+
+def sd_notify(msg):
+    # send a state change to systemd, does nothing if we are not started as a notify service
+    # https://www.freedesktop.org/software/systemd/man/sd_notify.html
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return
+    if path[0] == "@":
+        # abstract namespace socket
+        path = "\0" + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(msg.encode(), path)
+    except OSError as e:
+        _log.debug("Couldn't notify systemd. Exception: %s", e)
+
+
+def handle_signal(signum, frame):
+    # SIGTERM stops the main loop, SIGHUP reloads the config file
+    if signum == signal.SIGTERM:
+        _terminate.set()
+    elif signum == signal.SIGHUP:
+        _reload.set()
+    _wakeup.set()
+
+
+def start_status_server(path, get_status):
+    # every client connecting to the socket gets the last status as JSON, with its
+    # age in seconds taken from the monotonic clock, which NTP does not change
+    try:
+        os.unlink(path)
+    except OSError:
+        pass  # no socket left from an earlier run
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        server.listen()
+    except OSError as e:
+        _log.info("Cannot provide the status on %s: %s", path, e)
+        server.close()
+        return
+    threading.Thread(target=serve_status, args=(server, get_status), daemon=True).start()
+
+
+def serve_status(server, get_status):
+    while True:
+        try:
+            connection, _ = server.accept()
+        except OSError as e:
+            if server.fileno() == -1:
+                return  # the socket has been closed
+            # e.g. out of file descriptors, pause instead of spinning on the error
+            _log.warning("Couldn't accept a status connection. Exception: %s", e)
+            time.sleep(1.0)
+            continue
+        try:
+            with connection:
+                snapshot = get_status()
+                if snapshot is not None:
+                    (values, read_time) = snapshot
+                    connection.sendall(json.dumps(
+                        dict(values, age=time.monotonic() - read_time)).encode())
+        except OSError as e:
+            _log.debug("Couldn't send the status. Exception: %s", e)
+
+
+def get_button_function(name):
+    # resolve the configured name once, so a typo shows up at startup and not on the first press
+    try:
+        return button_functions[name]
+    except KeyError:
+        _log.error("Unknown button function '%s', falling back to 'nothing'", name)
+        return button_functions["nothing"]
 
 
 def parse_cmdline(args: Tuple[Any]) -> Namespace:
@@ -144,10 +314,17 @@ def parse_cmdline(args: Tuple[Any]) -> Namespace:
 
 
 def setup_logger(nodaemon: bool) -> None:
-    root_log = logging.getLogger()
+    root_log = _log
     root_log.setLevel("INFO")
     if not nodaemon:
-        root_log.addHandler(SystemdHandler())
+        # writing to the journal can block, so a background thread does it for the main loop
+        log_queue = queue.Queue(maxsize=10000)
+        root_log.addHandler(logging.handlers.QueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue, SystemdHandler(), respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        logging.basicConfig()
 
 
 class SystemdHandler(logging.Handler):
@@ -163,25 +340,45 @@ class SystemdHandler(logging.Handler):
         logging.DEBUG: "<7>",
         logging.NOTSET: "<7>"
     }
+    # journald expects one line per message, so we escape newlines
+    NEWLINE_ESCAPE = str.maketrans({"\n": "\\n"})
 
     def __init__(self, stream=sys.stdout):
         self.stream = stream
+        self._write = stream.write
+        self._flush = stream.flush
+        self._prefix = self.PREFIX.get
         logging.Handler.__init__(self)
 
     def emit(self, record):
         try:
-            msg = self.PREFIX[record.levelno] + self.format(record)
-            msg = msg.replace("\n", "\\n")
-            self.stream.write(msg + "\n")
-            self.stream.flush()
+            msg = self.format(record)
+            if "\n" in msg:
+                msg = msg.translate(self.NEWLINE_ESCAPE)
+            self._write(self._prefix(record.levelno, "<7>") + msg + "\n")
+            self._flush()
         except Exception:
             self.handleError(record)
 
 
-class Config(Mapping):
+def int_any_base(value):
+    # allows hex values like 0x37 in the config file
+    return int(value, 0)
+
+
+def to_bool(value):
+    # accepts the same spellings as ConfigParser.getboolean
+    try:
+        return ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError("Not a boolean: %s" % value) from None
+
+
+class Config(dict):
     DAEMON_SECTION = "attinydaemon"
     I2C_BUS = 'i2c bus'
     I2C_ADDRESS = 'i2c address'
+    I2C_FREQUENCY = 'i2c bus frequency'
     TIMEOUT = 'timeout'
     SLEEPTIME = 'sleeptime'
     PRIMED = 'primed'
@@ -205,25 +402,26 @@ class Config(Mapping):
     PULSE_LENGTH_OFF = 'pulse length off'
     SW_RECOVERY_DELAY = 'switch recovery delay'
 
-    MAX_INT = sys.maxsize
+    # options without a value are taken from the ATTiny in merge_and_sync_values
     DEFAULT_CONFIG = {
         DAEMON_SECTION: {
             I2C_ADDRESS: '0x37',
             I2C_BUS: '1',
-            TIMEOUT: str(MAX_INT),
-            SLEEPTIME: str(MAX_INT),
+            I2C_FREQUENCY: '100000',
+            TIMEOUT: None,
+            SLEEPTIME: None,
             PRIMED: 'False',
-            BAT_V_COEFFICIENT: str(MAX_INT),
-            BAT_V_CONSTANT: str(MAX_INT),
-            EXT_V_COEFFICIENT: str(MAX_INT),
-            EXT_V_CONSTANT: str(MAX_INT),
-            T_COEFFICIENT: str(MAX_INT),
-            T_CONSTANT: str(MAX_INT),
+            BAT_V_COEFFICIENT: None,
+            BAT_V_CONSTANT: None,
+            EXT_V_COEFFICIENT: None,
+            EXT_V_CONSTANT: None,
+            T_COEFFICIENT: None,
+            T_CONSTANT: None,
             FORCE_SHUTDOWN: 'True',
             LED_OFF_MODE: '0',
-            WARN_VOLTAGE: str(MAX_INT),
-            UPS_SHUTDOWN_VOLTAGE: str(MAX_INT),
-            RESTART_VOLTAGE: str(MAX_INT),
+            WARN_VOLTAGE: None,
+            UPS_SHUTDOWN_VOLTAGE: None,
+            RESTART_VOLTAGE: None,
             BUTTON_FUNCTION: "nothing",
             UPS_CONFIG: "0",
             VEXT_SHUTDOWN: 'False',
@@ -235,91 +433,205 @@ class Config(Mapping):
         }
     }
 
+    # every option with the function used to convert its value
+    OPTION_TYPES = (
+        (I2C_ADDRESS, int_any_base),
+        (I2C_BUS, int),
+        (I2C_FREQUENCY, int),
+        (TIMEOUT, int),
+        (SLEEPTIME, int),
+        (PRIMED, to_bool),
+        (BAT_V_COEFFICIENT, int),
+        (BAT_V_CONSTANT, int),
+        (EXT_V_COEFFICIENT, int),
+        (EXT_V_CONSTANT, int),
+        (T_COEFFICIENT, int),
+        (T_CONSTANT, int),
+        (FORCE_SHUTDOWN, to_bool),
+        (LED_OFF_MODE, int),
+        (WARN_VOLTAGE, int),
+        (UPS_SHUTDOWN_VOLTAGE, int),
+        (RESTART_VOLTAGE, int),
+        (BUTTON_FUNCTION, str),
+        (UPS_CONFIG, int_any_base),
+        (VEXT_SHUTDOWN, to_bool),
+        (PULSE_LENGTH, int),
+        (PULSE_LENGTH_ON, int),
+        (PULSE_LENGTH_OFF, int),
+        (SW_RECOVERY_DELAY, int),
+    )
+
+    # identifies the options, their converters and defaults the cache file was written
+    # with, so a cache file from a different version of the daemon is never used
+    CACHE_FORMAT = hashlib.sha256(json.dumps(
+        [[option, convert.__name__] for option, convert in OPTION_TYPES]
+        + sorted(DEFAULT_CONFIG[DAEMON_SECTION].items())).encode()).hexdigest()
+
+    # config values that are kept in sync with a 16 bit register of the ATTiny
+    SYNCED_REGISTERS = (
+        (WARN_VOLTAGE, ATTiny.REG_WARN_VOLTAGE),
+        (UPS_SHUTDOWN_VOLTAGE, ATTiny.REG_UPS_SHUTDOWN_VOLTAGE),
+        (RESTART_VOLTAGE, ATTiny.REG_RESTART_VOLTAGE),
+        (BAT_V_COEFFICIENT, ATTiny.REG_BAT_V_COEFFICIENT),
+        (BAT_V_CONSTANT, ATTiny.REG_BAT_V_CONSTANT),
+        (EXT_V_COEFFICIENT, ATTiny.REG_EXT_V_COEFFICIENT),
+        (EXT_V_CONSTANT, ATTiny.REG_EXT_V_CONSTANT),
+        (T_COEFFICIENT, ATTiny.REG_T_COEFFICIENT),
+        (T_CONSTANT, ATTiny.REG_T_CONSTANT),
+    )
+
+    # the converted options are the dict itself, so config[option] is a plain dict lookup
+    __slots__ = ('configfile_name', 'parser',
+                 '_cache_key', '_cache_storage', '_cache_file_name')
+
     def __init__(self, cfgfile):
-        global _configfile_default  # simpler to change than a class variable
         if cfgfile:
             self.configfile_name = cfgfile
         else:
             self.configfile_name = _configfile_default
-        self.config = {}
-        self.parser = ConfigParser(allow_no_value=True)
-        self._storage = dict()
+        self.parser = None
+        # parsed values of the config file, keyed by its modification time and size
+        self._cache_key = None
+        self._cache_storage = None
+        self._cache_file_name = self.configfile_name + ".cache"
 
-    def __getitem__(self, key):
-        return self._storage[key]
+    def read_config(self):
+        cache_key = self._config_file_key()
+        if cache_key is not None and cache_key == self._cache_key:
+            _log.debug("config file unchanged, using cached values")
+            self.update(self._cache_storage)
+            return
+
+        if cache_key is not None and self._read_cache_file(cache_key):
+            _log.debug("config file unchanged since the last start, using the cache file")
+        else:
+            self._parse_config()
+            if cache_key is not None:
+                self._write_cache_file(cache_key)
 
-    def __iter__(self):
-        return iter(self._storage)
+        try:
+            _log.setLevel(self.parser.get(self.DAEMON_SECTION, self.LOG_LEVEL))
+        except Exception as e:
+            _log.error("Cannot convert option '%s': %s", self.LOG_LEVEL, e)
+            sys.exit(1)
+        _log.debug("config variables are set")
 
-    def __len__(self):
-        return len(self._storage)
+        self._cache_key = cache_key
+        self._cache_storage = dict(self)
 
-    def read_config(self):
-        self.parser.read_dict(self.DEFAULT_CONFIG)
+    def _new_parser(self, sections):
+        # every parse starts from a fresh parser, so after a reload options
+        # removed from the config file fall back to their defaults
+        self.parser = ConfigParser(allow_no_value=True)
+        self.parser.read_dict(sections)
+
+    def _parse_config(self):
+        self._new_parser(self.DEFAULT_CONFIG)
 
         if not os.path.isfile(self.configfile_name):
-            logging.info("No Config File. Trying to create one.")
+            _log.info("No Config File. Trying to create one.")
             # self.write_config()
 
         else:
             try:
                 self.parser.read(self.configfile_name)
             except Exception:
-                logging.warning("cannot read config file. Using default values")
-
+                _log.warning("cannot read config file. Using default values")
+
+        # convert from a single snapshot of the section instead of a parser lookup per option
+        options = dict(self.parser.items(self.DAEMON_SECTION))
+        for option, convert in self.OPTION_TYPES:
+            value = options[option]
+            # items() returns options without a value as empty strings
+            if not value and self.DEFAULT_CONFIG[self.DAEMON_SECTION][option] is None:
+                self[option] = None
+                continue
+            try:
+                self[option] = convert(value)
+            except Exception as e:
+                _log.error("Cannot convert option '%s': %s", option, e)
+                sys.exit(1)
+
+        # the i2c timing is derived from the bus frequency
+        if self[self.I2C_FREQUENCY] <= 0:
+            default = self.DEFAULT_CONFIG[self.DAEMON_SECTION][self.I2C_FREQUENCY]
+            _log.error("Option '%s' must be positive, using the default %s",
+                       self.I2C_FREQUENCY, default)
+            self[self.I2C_FREQUENCY] = int(default)
+
+    # The cache file holds the raw option values and the converted values of the
+    # config file, together with the modification time and size of the file.
+    def _read_cache_file(self, cache_key):
+        try:
+            with open(self._cache_file_name, 'r') as cache_file:
+                (cache_format, key, raw_options, storage) = json.load(cache_file)
+        except Exception:
+            return False
+        if cache_format != self.CACHE_FORMAT or key != list(cache_key):
+            return False
+        if any(option not in storage for option, convert in self.OPTION_TYPES):
+            return False
+        # the parser is needed to write back changes of the merge
+        self._new_parser({self.DAEMON_SECTION: raw_options})
+        self.update(storage)
+        return True
+
+    def _write_cache_file(self, cache_key):
+        raw_options = dict(self.parser.items(self.DAEMON_SECTION, raw=True))
         try:
-            self._storage[self.I2C_ADDRESS] = int(self.parser.get(self.DAEMON_SECTION, self.I2C_ADDRESS), 0)
-            self._storage[self.I2C_BUS] = self.parser.getint(self.DAEMON_SECTION, self.I2C_BUS)
-            self._storage[self.TIMEOUT] = self.parser.getint(self.DAEMON_SECTION, self.TIMEOUT)
-            self._storage[self.SLEEPTIME] = self.parser.getint(self.DAEMON_SECTION, self.SLEEPTIME)
-            self._storage[self.PRIMED] = self.parser.getboolean(self.DAEMON_SECTION, self.PRIMED)
-            self._storage[self.BAT_V_COEFFICIENT] = self.parser.getint(self.DAEMON_SECTION, self.BAT_V_COEFFICIENT)
-            self._storage[self.BAT_V_CONSTANT] = self.parser.getint(self.DAEMON_SECTION, self.BAT_V_CONSTANT)
-            self._storage[self.EXT_V_COEFFICIENT] = self.parser.getint(self.DAEMON_SECTION, self.EXT_V_COEFFICIENT)
-            self._storage[self.EXT_V_CONSTANT] = self.parser.getint(self.DAEMON_SECTION, self.EXT_V_CONSTANT)
-            self._storage[self.T_COEFFICIENT] = self.parser.getint(self.DAEMON_SECTION, self.T_COEFFICIENT)
-            self._storage[self.T_CONSTANT] = self.parser.getint(self.DAEMON_SECTION, self.T_CONSTANT)
-            self._storage[self.FORCE_SHUTDOWN] = self.parser.getboolean(self.DAEMON_SECTION, self.FORCE_SHUTDOWN)
-            self._storage[self.LED_OFF_MODE] = self.parser.getint(self.DAEMON_SECTION, self.LED_OFF_MODE)
-            self._storage[self.WARN_VOLTAGE] = self.parser.getint(self.DAEMON_SECTION, self.WARN_VOLTAGE)
-            self._storage[self.UPS_SHUTDOWN_VOLTAGE] = self.parser.getint(self.DAEMON_SECTION, self.UPS_SHUTDOWN_VOLTAGE)
-            self._storage[self.RESTART_VOLTAGE] = self.parser.getint(self.DAEMON_SECTION, self.RESTART_VOLTAGE)
-            self._storage[self.BUTTON_FUNCTION] = self.parser.get(self.DAEMON_SECTION, self.BUTTON_FUNCTION)
-            self._storage[self.UPS_CONFIG] = int(self.parser.get(self.DAEMON_SECTION, self.UPS_CONFIG), 0)
-            self._storage[self.VEXT_SHUTDOWN] = self.parser.getboolean(self.DAEMON_SECTION, self.VEXT_SHUTDOWN)
-            self._storage[self.PULSE_LENGTH] = self.parser.getint(self.DAEMON_SECTION, self.PULSE_LENGTH)
-            self._storage[self.PULSE_LENGTH_ON] = self.parser.getint(self.DAEMON_SECTION, self.PULSE_LENGTH_ON)
-            self._storage[self.PULSE_LENGTH_OFF] = self.parser.getint(self.DAEMON_SECTION, self.PULSE_LENGTH_OFF)
-            self._storage[self.SW_RECOVERY_DELAY] = self.parser.getint(self.DAEMON_SECTION, self.SW_RECOVERY_DELAY)
-            logging.getLogger().setLevel(self.parser.get(self.DAEMON_SECTION, self.LOG_LEVEL))
-            logging.debug("config variables are set")
+            with open(self._cache_file_name, 'w') as cache_file:
+                json.dump((self.CACHE_FORMAT, cache_key, raw_options, dict(self)), cache_file)
         except Exception as e:
-            logging.error("Cannot convert option: " + str(e))
-            exit(1)
+            _log.debug("Couldn't write the config cache file. Exception: %s", e)
+
+    def _config_file_key(self):
+        try:
+            st = os.stat(self.configfile_name)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
 
     def write_config(self):
+        buffer = io.StringIO()
+        self.parser.write(buffer)
+        content = buffer.getvalue()
+
+        config_path = Path(self.configfile_name)
+        try:
+            if config_path.read_text() == content:
+                _log.debug("config file unchanged, not writing it")
+                return
+        except OSError:
+            pass  # no config file yet
+
+        # write to a temporary file and rename it, a power loss must not leave a broken config
+        # fsync before the rename, otherwise the rename can reach the SD card before the data
         try:
-            cfgfile = open(self.configfile_name, 'w')
-            self.parser.write(cfgfile)
-            cfgfile.close()
+            tmp_path = config_path.with_name(config_path.name + ".tmp")
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, content.encode())
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, config_path)
         except Exception:
-            logging.warning("cannot write config file.")
+            _log.warning("cannot write config file.")
 
     @staticmethod
     def calc_sleeptime(val):
-        global minimum_boot_time
         # we should have at least 30 seconds to boot
         # before the timeout occurs
         sleeptime = val - minimum_boot_time
         if sleeptime < 10:
             sleeptime = int(val / 2)
         if sleeptime < minimum_boot_time:
-            logging.warning("Sleeptime is low. Ensure that the Raspberry can boot in " + str(sleeptime) + " seconds or change the config file.")
+            _log.warning("Sleeptime is low. Ensure that the Raspberry can boot in %s seconds or change the config file.", sleeptime)
         return sleeptime
 
     # not the perfect place for the method, but good enough
     def merge_and_sync_values(self, attiny):
-        logging.debug("Merge Values and save if necessary")
+        _log.debug("Merge Values and save if necessary")
         changed_config = False
 
         attiny_primed = attiny.get_primed()
@@ -334,130 +646,108 @@ class Config(Mapping):
         attiny_vext_off_is_shutdown = attiny.get_vext_off_is_shutdown()
 
 
-        if self._storage[self.TIMEOUT] == self.MAX_INT:
+        if self[self.TIMEOUT] is None:
             # timeout was not set in the config file
             # we will get timeout, primed, ups configuration, 
             # pulse length, pulse length on, pulse length off,
             # switch recovery delay, vext_is_shutdown and
             # force_shutdown from the ATTiny
-            logging.debug("Getting Timeout from ATTiny")
-            self._storage[self.PRIMED] = attiny_primed
-            self._storage[self.TIMEOUT] = attiny_timeout
-            self._storage[self.FORCE_SHUTDOWN] = attiny_force_shutdown
-            self._storage[self.LED_OFF_MODE] = attiny_led_off_mode
-            self._storage[self.UPS_CONFIG] = attiny_ups_configuration
-            self._storage[self.PULSE_LENGTH] = attiny_pulse_length
-            self._storage[self.PULSE_LENGTH_ON] = attiny_pulse_length_on
-            self._storage[self.PULSE_LENGTH_OFF] = attiny_pulse_length_off
-            self._storage[self.SW_RECOVERY_DELAY] = attiny_switch_recovery_delay
-            self._storage[self.VEXT_SHUTDOWN] = attiny_vext_off_is_shutdown
+            _log.debug("Getting Timeout from ATTiny")
+            self[self.PRIMED] = attiny_primed
+            self[self.TIMEOUT] = attiny_timeout
+            self[self.FORCE_SHUTDOWN] = attiny_force_shutdown
+            self[self.LED_OFF_MODE] = attiny_led_off_mode
+            self[self.UPS_CONFIG] = attiny_ups_configuration
+            self[self.PULSE_LENGTH] = attiny_pulse_length
+            self[self.PULSE_LENGTH_ON] = attiny_pulse_length_on
+            self[self.PULSE_LENGTH_OFF] = attiny_pulse_length_off
+            self[self.SW_RECOVERY_DELAY] = attiny_switch_recovery_delay
+            self[self.VEXT_SHUTDOWN] = attiny_vext_off_is_shutdown
 
             self.parser.set(self.DAEMON_SECTION, self.TIMEOUT,
-                            str(self._storage[self.TIMEOUT]))
+                            str(self[self.TIMEOUT]))
             self.parser.set(self.DAEMON_SECTION, self.PRIMED,
-                            str(self._storage[self.PRIMED]))
+                            str(self[self.PRIMED]))
             self.parser.set(self.DAEMON_SECTION, self.FORCE_SHUTDOWN,
-                            str(self._storage[self.FORCE_SHUTDOWN]))
+                            str(self[self.FORCE_SHUTDOWN]))
             self.parser.set(self.DAEMON_SECTION, self.LED_OFF_MODE,
-                            str(self._storage[self.LED_OFF_MODE]))
+                            str(self[self.LED_OFF_MODE]))
             self.parser.set(self.DAEMON_SECTION, self.UPS_CONFIG,
-                            str(self._storage[self.UPS_CONFIG]))
+                            str(self[self.UPS_CONFIG]))
             self.parser.set(self.DAEMON_SECTION, self.PULSE_LENGTH,
-                            str(self._storage[self.PULSE_LENGTH]))
+                            str(self[self.PULSE_LENGTH]))
             self.parser.set(self.DAEMON_SECTION, self.PULSE_LENGTH_ON,
-                            str(self._storage[self.PULSE_LENGTH_ON]))
+                            str(self[self.PULSE_LENGTH_ON]))
             self.parser.set(self.DAEMON_SECTION, self.PULSE_LENGTH_OFF,
-                            str(self._storage[self.PULSE_LENGTH_OFF]))
+                            str(self[self.PULSE_LENGTH_OFF]))
             self.parser.set(self.DAEMON_SECTION, self.SW_RECOVERY_DELAY,
-                            str(self._storage[self.SW_RECOVERY_DELAY]))
+                            str(self[self.SW_RECOVERY_DELAY]))
             self.parser.set(self.DAEMON_SECTION, self.VEXT_SHUTDOWN,
-                            str(self._storage[self.VEXT_SHUTDOWN]))
+                            str(self[self.VEXT_SHUTDOWN]))
             changed_config = True
         else:
-            if attiny_timeout != self._storage[self.TIMEOUT]:
-                logging.debug("Writing Timeout to ATTiny")
-                attiny.set_timeout(self._storage[self.TIMEOUT])
-            if attiny_primed != self._storage[self.PRIMED]:
-                logging.debug("Writing Primed to ATTiny")
-                attiny.set_primed(self._storage[self.PRIMED])
-            if attiny_force_shutdown != self._storage[self.FORCE_SHUTDOWN]:
-                logging.debug("Writing Force_Shutdown to ATTiny")
-                attiny.set_force_shutdown(self._storage[self.FORCE_SHUTDOWN])
-            if attiny_led_off_mode != self._storage[self.LED_OFF_MODE]:
-                logging.debug("Writing LED_Off_Mode to ATTiny")
-                attiny.set_led_off_mode(self._storage[self.LED_OFF_MODE])
-            if attiny_ups_configuration != self._storage[self.UPS_CONFIG]:
-                logging.debug("Writing UPS Configuration to ATTiny")
-                attiny.set_ups_configuration(self._storage[self.UPS_CONFIG])
-            if attiny_pulse_length != self._storage[self.PULSE_LENGTH]:
-                logging.debug("Writing Pulse Length to ATTiny")
-                attiny.set_pulse_length(self._storage[self.PULSE_LENGTH])
-            if attiny_pulse_length_on != self._storage[self.PULSE_LENGTH_ON]:
-                logging.debug("Writing Pulse Length On to ATTiny")
-                attiny.set_pulse_length_on(self._storage[self.PULSE_LENGTH_ON])
-            if attiny_pulse_length_off != self._storage[self.PULSE_LENGTH_OFF]:
-                logging.debug("Writing Pulse Length Off to ATTiny")
-                attiny.set_pulse_length_off(self._storage[self.PULSE_LENGTH_OFF])
-            if attiny_switch_recovery_delay != self._storage[self.SW_RECOVERY_DELAY]:
-                logging.debug("Writing Switch Recovery Delay to ATTiny")
-                attiny.set_switch_recovery_delay(self._storage[self.SW_RECOVERY_DELAY])
-            if attiny_vext_off_is_shutdown != self._storage[self.VEXT_SHUTDOWN]:
-                logging.debug("Writing Vext off is Shutdown to ATTiny")
-                attiny.set_vext_off_is_shutdown(self._storage[self.VEXT_SHUTDOWN])
-
-        # check for max_int and only set if sleeptime is set to that value
-        if self._storage[self.SLEEPTIME] == self.MAX_INT:
-            logging.debug("Sleeptime not set, calculating from timeout value")
-            self._storage[self.SLEEPTIME] = self.calc_sleeptime(self._storage[self.TIMEOUT])
+            if attiny_timeout != self[self.TIMEOUT]:
+                _log.debug("Writing Timeout to ATTiny")
+                attiny.set_timeout(self[self.TIMEOUT], verify=True)
+            if attiny_primed != self[self.PRIMED]:
+                _log.debug("Writing Primed to ATTiny")
+                attiny.set_primed(self[self.PRIMED], verify=True)
+            if attiny_force_shutdown != self[self.FORCE_SHUTDOWN]:
+                _log.debug("Writing Force_Shutdown to ATTiny")
+                attiny.set_force_shutdown(self[self.FORCE_SHUTDOWN], verify=True)
+            if attiny_led_off_mode != self[self.LED_OFF_MODE]:
+                _log.debug("Writing LED_Off_Mode to ATTiny")
+                attiny.set_led_off_mode(self[self.LED_OFF_MODE], verify=True)
+            if attiny_ups_configuration != self[self.UPS_CONFIG]:
+                _log.debug("Writing UPS Configuration to ATTiny")
+                attiny.set_ups_configuration(self[self.UPS_CONFIG], verify=True)
+            if attiny_pulse_length != self[self.PULSE_LENGTH]:
+                _log.debug("Writing Pulse Length to ATTiny")
+                attiny.set_pulse_length(self[self.PULSE_LENGTH], verify=True)
+            if attiny_pulse_length_on != self[self.PULSE_LENGTH_ON]:
+                _log.debug("Writing Pulse Length On to ATTiny")
+                attiny.set_pulse_length_on(self[self.PULSE_LENGTH_ON], verify=True)
+            if attiny_pulse_length_off != self[self.PULSE_LENGTH_OFF]:
+                _log.debug("Writing Pulse Length Off to ATTiny")
+                attiny.set_pulse_length_off(self[self.PULSE_LENGTH_OFF], verify=True)
+            if attiny_switch_recovery_delay != self[self.SW_RECOVERY_DELAY]:
+                _log.debug("Writing Switch Recovery Delay to ATTiny")
+                attiny.set_switch_recovery_delay(self[self.SW_RECOVERY_DELAY], verify=True)
+            if attiny_vext_off_is_shutdown != self[self.VEXT_SHUTDOWN]:
+                _log.debug("Writing Vext off is Shutdown to ATTiny")
+                attiny.set_vext_off_is_shutdown(self[self.VEXT_SHUTDOWN], verify=True)
+
+        # only calculate the sleeptime if it is not set
+        if self[self.SLEEPTIME] is None:
+            _log.debug("Sleeptime not set, calculating from timeout value")
+            self[self.SLEEPTIME] = self.calc_sleeptime(self[self.TIMEOUT])
             self.parser.set(self.DAEMON_SECTION, self.SLEEPTIME,
-                            str(self._storage[self.SLEEPTIME]))
-            logging.debug(self._storage[self.SLEEPTIME])
-            changed_config = True
-
-        if self._sync_Voltage(self.WARN_VOLTAGE, attiny, attiny.REG_WARN_VOLTAGE):
+                            str(self[self.SLEEPTIME]))
+            _log.debug("Calculated sleeptime is %s seconds", self[self.SLEEPTIME])
             changed_config = True
 
-        if self._sync_Voltage(self.UPS_SHUTDOWN_VOLTAGE, attiny, attiny.REG_UPS_SHUTDOWN_VOLTAGE):
-            changed_config = True
-
-        if self._sync_Voltage(self.RESTART_VOLTAGE, attiny, attiny.REG_RESTART_VOLTAGE):
-            changed_config = True
-
-        if self._sync_Voltage(self.BAT_V_COEFFICIENT, attiny, attiny.REG_BAT_V_COEFFICIENT):
-            changed_config = True
-
-        if self._sync_Voltage(self.BAT_V_CONSTANT, attiny, attiny.REG_BAT_V_CONSTANT):
-            changed_config = True
-
-        if self._sync_Voltage(self.EXT_V_COEFFICIENT, attiny, attiny.REG_EXT_V_COEFFICIENT):
-            changed_config = True
-
-        if self._sync_Voltage(self.EXT_V_CONSTANT, attiny, attiny.REG_EXT_V_CONSTANT):
-            changed_config = True
-
-        if self._sync_Voltage(self.T_COEFFICIENT, attiny, attiny.REG_T_COEFFICIENT):
-            changed_config = True
-
-        if self._sync_Voltage(self.T_CONSTANT, attiny, attiny.REG_T_CONSTANT):
-            changed_config = True
+        attiny_values = attiny.get_16bit_values(
+            [attiny_reg for (_, attiny_reg) in self.SYNCED_REGISTERS])
+        for voltage_type, attiny_reg in self.SYNCED_REGISTERS:
+            if self._sync_Voltage(voltage_type, attiny_values[attiny_reg], attiny, attiny_reg):
+                changed_config = True
 
         if changed_config:
-            logging.debug("Writing new config file")
+            _log.debug("Writing new config file")
             self.write_config()
 
-    def _sync_Voltage(self, voltage_type, attiny, attiny_reg):
-        attiny_voltage = attiny.get_16bit_value(attiny_reg)
-        if self._storage[voltage_type] == self.MAX_INT:
-            logging.debug("Getting Register " + hex(attiny_reg) + " from ATTiny")
-            self._storage[voltage_type] = attiny_voltage
+    def _sync_Voltage(self, voltage_type, attiny_voltage, attiny, attiny_reg):
+        if self[voltage_type] is None:
+            _log.debug("Getting Register %#x from ATTiny", attiny_reg)
+            self[voltage_type] = attiny_voltage
             self.parser.set(self.DAEMON_SECTION, voltage_type,
-                            str(self._storage[voltage_type]))
+                            str(self[voltage_type]))
             changed_config = True
         else:
             changed_config = False
-            if attiny_voltage != self._storage[voltage_type]:
-                logging.debug("Writing Register " + hex(attiny_reg) + " to ATTiny")
-                attiny.set_16bit_value(attiny_reg, self._storage[voltage_type])
+            if attiny_voltage != self[voltage_type]:
+                _log.debug("Writing Register %#x to ATTiny", attiny_reg)
+                attiny.set_16bit_value(attiny_reg, self[voltage_type], verify=True)
         return changed_config
 
 
@@ -2,7 +2,10 @@
 
 import paho.mqtt.publish as publish
 import paho.mqtt.client as mqtt
+import json
 import logging
+import socket
+import time
 
 from attiny_i2c import ATTiny
 
@@ -10,6 +13,8 @@ from attiny_i2c import ATTiny
 # Change the following settings to your needs and add the following line to the
 # crontab of the user pi (without the leading hash-sign):
 # * * * * * /opt/attiny_daemon/attiny_daemon_mqtt_status.py
+# Alternatively set _interval below and start the script once, e.g., as a systemd
+# service. It then keeps its MQTT connection open and publishes every _interval seconds.
 
 # Settings specific to MQTT
 _topic = "topic"
@@ -18,13 +23,19 @@ _port = 1883
 _client_id = ""
 _user = None
 _password = None
-#_additional_info = '"hostname" : "myhost"'
+#_additional_info = {"hostname": "myhost"}
 _additional_info = None
+_interval = None    # publish once and exit (cron), or the seconds between two publishes
 
 # Settings specific to ATTiny_Daemon
-_time_const = 1.0   # used as a pause between i2c communications, the ATTiny is slow
+_time_const = 1.0   # maximum back-off between i2c retries, the ATTiny is slow
 _num_retries = 10   # the number of retries when reading from or writing to the ATTiny_Daemon
 _i2c_address = 0x37 # the I2C address that is used for the ATTiny_Daemon
+# The daemon hands out the values it has last read from the ATTiny (firmware 2.13.16 or
+# later) on this socket. They are used if they are not older than _max_status_age seconds,
+# otherwise the script reads the ATTiny itself. Set _status_socket to None to always do that.
+_status_socket = "/run/attiny_daemon/status.sock"
+_max_status_age = 120
 
 ### Here begins the code
 
@@ -33,6 +44,44 @@ def get_uptime():
         uptime_seconds = float(f.readline().split()[0])
     return uptime_seconds
 
+def get_daemon_status():
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(1.0)
+            connection.connect(_status_socket)
+            message = b""
+            while True:
+                data = connection.recv(4096)
+                if not data:
+                    break
+                message += data
+        daemon_status = json.loads(message)
+    except (OSError, ValueError) as e:
+        logging.debug("Couldn't get the status from the daemon: %s", e)
+        return None
+    # the daemon reports how many seconds ago it has read the values
+    age = daemon_status.get("age")
+    if age is None or age > _max_status_age:
+        return None
+    return daemon_status
+
+def build_status(attiny):
+    daemon_status = None
+    if _status_socket is not None:
+        daemon_status = get_daemon_status()
+
+    if daemon_status is None:
+        # access data, an error is signalled by a return value of 0xFFFFFFFF/4294967295
+        daemon_status = attiny.refresh()
+    status = {
+        "temperature": daemon_status["temperature"],
+        "battery_voltage": daemon_status["battery_voltage"],
+        "uptime": get_uptime()
+    }
+    if _additional_info is not None:
+        status.update(_additional_info)
+    return json.dumps(status)
+
 # set up logging
 root_log = logging.getLogger()
 root_log.setLevel("INFO")
@@ -41,25 +90,28 @@ root_log.setLevel("INFO")
 bus = 1
 attiny = ATTiny(bus, _i2c_address, _time_const, _num_retries)
 
-# access data, an error is signalled by a return value of 0xFFFFFFFF/4294967295
-temperature = str(attiny.get_temperature())
-voltage = str(attiny.get_bat_voltage())
-uptime = str(get_uptime())
-
-#build output
-json_string = '{"temperature" : ' + temperature  \
-              + ', "battery_voltage" : ' + voltage \
-              + ', "uptime" : ' + uptime;
-if _additional_info == None:
-    json_string = json_string + '}';
-else:
-    json_string = json_string + ', ' + _additional_info + '}'
-
 # build auth dict
 _auth = None
-if _user != None:
+if _user is not None:
     _auth = {'username':_user, 'password':_password}
 
-# send data to MQTT
-publish.single(_topic, payload=json_string, qos=0, retain=False, hostname=_hostname, port=_port, client_id=_client_id, keepalive=60, will=None, auth=_auth, tls=None, protocol=mqtt.MQTTv311, transport="tcp")
+if _interval is None:
+    # send data to MQTT
+    publish.single(_topic, payload=build_status(attiny), qos=0, retain=False, hostname=_hostname, port=_port, client_id=_client_id, keepalive=60, will=None, auth=_auth, tls=None, protocol=mqtt.MQTTv311, transport="tcp")
+else:
+    # one connection for all messages, the network loop thread handles keepalive and reconnects
+    try:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=_client_id, protocol=mqtt.MQTTv311, transport="tcp")
+    except AttributeError:
+        # paho-mqtt before 2.0 has no callback API versions
+        client = mqtt.Client(client_id=_client_id, protocol=mqtt.MQTTv311, transport="tcp")
+    if _auth is not None:
+        client.username_pw_set(_auth['username'], _auth['password'])
+    client.connect(_hostname, _port, keepalive=60)
+    client.loop_start()
 
+    next_publish = time.monotonic()
+    while True:
+        client.publish(_topic, payload=build_status(attiny), qos=0, retain=False)
+        next_publish += _interval
+        time.sleep(max(0, next_publish - time.monotonic()))
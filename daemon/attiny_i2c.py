@@ -1,15 +1,35 @@
+import errno
 import logging
+import math
 import os
 import sys
 import time
-import smbus
 import struct
+try:
+    # smbus2 can combine a write and a read in one transfer
+    from smbus2 import SMBus, i2c_msg
+except ImportError:
+    from smbus import SMBus
+    i2c_msg = None
 from typing import Tuple, Any
 from configparser import ConfigParser
 from argparse import ArgumentParser, Namespace
 from collections.abc import Mapping
 from pathlib import Path
 
+
+def _crc_table(polynome):
+    # the CRC of every single byte, computed bit by bit only once
+    table = bytearray(256)
+    for n in range(256):
+      crc = n
+      for bitnumber in range(0,8):
+        if crc & 0x80 : crc = ( crc << 1 ) ^ polynome
+        else          : crc = ( crc << 1 )
+      table[n] = crc & 0xFF
+    return bytes(table)
+
+
 class ATTiny:
     REG_LAST_ACCESS          = 0x01
     REG_BAT_VOLTAGE          = 0x11
@@ -42,128 +62,213 @@ class ATTiny:
     REG_INTERNAL_STATE       = 0x84
     REG_UPTIME               = 0x85
     REG_MCU_STATUS_REG       = 0x86
+    REG_STATUS               = 0x87
     REG_INIT_EEPROM          = 0xFF
 
-    _POLYNOME = 0x31
+    # the first firmware version providing the status register
+    STATUS_BLOCK_VERSION = (2, 13, 16)
+    # the names of the values in the status register, in the order of get_status_block
+    STATUS_NAMES = ("should_shutdown", "last_access", "battery_voltage",
+                    "external_voltage", "temperature")
 
-    def __init__(self, bus_number, address, time_const, num_retries):
+    _POLYNOME = 0x31
+    _CRC_TABLE = _crc_table(_POLYNOME)
+    _MIN_PAUSE = 200e-6  # lower bound for the pause before retrying an i2c transfer
+    _CACHE_TTL = 1.0     # seconds a 16 bit value read from the ATTiny is reused
+    # registers that cannot change while the ATTiny is running are read only once
+    _CACHE_TTLS = {REG_VERSION: math.inf, REG_FUSE_LOW: math.inf,
+                   REG_FUSE_HIGH: math.inf, REG_FUSE_EXTENDED: math.inf}
+
+    def __init__(self, bus_number, address, time_const, num_retries, bus_frequency=100000):
         self._bus_number = bus_number
         self._address = address
         self._time_const = time_const
         self._num_retries = num_retries
+        # time to transfer a single byte on the bus (8 data bits + ack)
+        self._byte_time = 9 / bus_frequency
+        # register -> (value, expiry time) for the 16 bit registers, the fuses and the version
+        self._cache = {}
+        self._bus = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open_bus(self):
+        # the bus is opened with the first transfer and then kept open
+        if self._bus is None:
+            self._bus = SMBus(self._bus_number)
+        return self._bus
+
+    def close(self):
+        if self._bus is not None:
+            self._bus.close()
+            self._bus = None
+
+    def _backoff(self, attempt, nbytes):
+        # pause after a failed transfer: the first retry follows after the time the
+        # transfer of nbytes takes on the wire, then the pause doubles from a quarter
+        # of the time constant up to the full time constant. A stalled ATTiny (wake-up,
+        # EEPROM write) thus still gets several seconds before we give up
+        if attempt == 0:
+            pause = max(self._byte_time * nbytes, self._MIN_PAUSE)
+        else:
+            pause = self._time_const * 2**min(attempt - 3, 0)
+        time.sleep(pause)
+
+    def _cached(self, register):
+        (val, expiry) = self._cache.get(register, (None, 0))
+        if val is not None and time.monotonic() < expiry:
+            return val
+        return None
+
+    def _store(self, register, val):
+        self._cache[register] = (val, time.monotonic() + self._CACHE_TTLS.get(register, self._CACHE_TTL))
+
+    @staticmethod
+    def _is_permanent(e):
+        # the i2c adapter itself has gone away, retrying cannot help
+        return isinstance(e, OSError) and e.errno == errno.ENODEV
+
+    def _write_read(self, bus, register, arg_list, nbytes):
+        # write the register and read it back with a repeated start in a single
+        # transfer, the ATTiny answers with the register that has just been written
+        write = i2c_msg.write(self._address, [register] + arg_list)
+        read = i2c_msg.read(self._address, nbytes)
+        bus.i2c_rdwr(write, read)
+        return list(read)
 
     def addCrc(self, crc, n):
-      for bitnumber in range(0,8):
-        if ( n ^ crc ) & 0x80 : crc = ( crc << 1 ) ^ self._POLYNOME
-        else                  : crc = ( crc << 1 )
-        n = n << 1
-      return crc & 0xFF
+      return self._CRC_TABLE[(crc ^ n) & 0xFF]
 
     def calcCRC(self, register, read, len):
-      crc = self.addCrc(0, register)
+      table = self._CRC_TABLE
+      crc = table[register]
       for elem in range(0, len):
-        crc = self.addCrc(crc, read[elem])
+        crc = table[crc ^ read[elem]]
       return crc
 
-    def set_timeout(self, timeout):
-        return self.set_8bit_value(self.REG_TIMEOUT, timeout)
+    def set_timeout(self, timeout, verify=False):
+        return self.set_8bit_value(self.REG_TIMEOUT, timeout, verify)
 
-    def set_primed(self, primed):
-        return self.set_8bit_value(self.REG_PRIMED, primed)
+    def set_primed(self, primed, verify=False):
+        return self.set_8bit_value(self.REG_PRIMED, primed, verify)
 
     def init_eeprom(self):
         return self.set_8bit_value(self.REG_INIT_EEPROM, 1)
 
-    def set_should_shutdown(self, value):
-        return self.set_8bit_value(self.REG_SHOULD_SHUTDOWN, value)
+    def set_should_shutdown(self, value, verify=False):
+        return self.set_8bit_value(self.REG_SHOULD_SHUTDOWN, value, verify)
 
-    def set_force_shutdown(self, value):
-        return self.set_8bit_value(self.REG_FORCE_SHUTDOWN, value)
+    def set_force_shutdown(self, value, verify=False):
+        return self.set_8bit_value(self.REG_FORCE_SHUTDOWN, value, verify)
 
-    def set_led_off_mode(self, value):
-        return self.set_8bit_value(self.REG_LED_OFF_MODE, value)
+    def set_led_off_mode(self, value, verify=False):
+        return self.set_8bit_value(self.REG_LED_OFF_MODE, value, verify)
 
-    def set_ups_configuration(self, value):
-        return self.set_8bit_value(self.REG_UPS_CONFIG, value)
+    def set_ups_configuration(self, value, verify=False):
+        return self.set_8bit_value(self.REG_UPS_CONFIG, value, verify)
 
-    def set_vext_off_is_shutdown(self, value):
-        return self.set_8bit_value(self.REG_VEXT_OFF_IS_SHUTDOWN, value)
+    def set_vext_off_is_shutdown(self, value, verify=False):
+        return self.set_8bit_value(self.REG_VEXT_OFF_IS_SHUTDOWN, value, verify)
 
-    def set_8bit_value(self, register, value):
+    def set_8bit_value(self, register, value, verify=False):
         crc = self.addCrc(0, register)
         crc = self.addCrc(crc, value)
 
         arg_list = [value, crc]
         for x in range(self._num_retries):
-            bus = smbus.SMBus(self._bus_number)
-            time.sleep(self._time_const)
+            bus = self._open_bus()
             try:
-                bus.write_i2c_block_data(self._address, register, arg_list)
-                bus.close()
-                if (self.get_8bit_value(register)) == value:
-                    return True
+                # the ATTiny silently drops writes with a wrong CRC, only a read-back tells us
+                if verify and i2c_msg is not None:
+                    read = self._write_read(bus, register, arg_list, 2)
+                    if read[1] == self.calcCRC(register, read, 1) and read[0] == value:
+                        return True
+                    logging.debug("Couldn't verify 8 bit register %#x.", register)
+                else:
+                    bus.write_i2c_block_data(self._address, register, arg_list)
+                    if not verify or self.get_8bit_value(register) == value:
+                        return True
             except Exception as e:
-                logging.debug("Couldn't set 8 bit register " + hex(register) + ". Exception: " + str(e))
-        logging.warning("Couldn't set 8 bit register after " + str(x) + " retries.")
+                self.close()  # reopen the bus with the next attempt
+                logging.debug("Couldn't set 8 bit register %#x. Exception: %s", register, e)
+                if self._is_permanent(e):
+                    break
+            self._backoff(x, 3)
+        logging.warning("Couldn't set 8 bit register after %s retries.", x)
         return False
 
-    def set_restart_voltage(self, value):
-        return self.set_16bit_value(self.REG_RESTART_VOLTAGE, value)
+    def set_restart_voltage(self, value, verify=False):
+        return self.set_16bit_value(self.REG_RESTART_VOLTAGE, value, verify)
 
-    def set_warn_voltage(self, value):
-        return self.set_16bit_value(self.REG_WARN_VOLTAGE, value)
+    def set_warn_voltage(self, value, verify=False):
+        return self.set_16bit_value(self.REG_WARN_VOLTAGE, value, verify)
 
-    def set_ups_shutdown_voltage(self, value):
-        return self.set_16bit_value(self.REG_UPS_SHUTDOWN_VOLTAGE, value)
+    def set_ups_shutdown_voltage(self, value, verify=False):
+        return self.set_16bit_value(self.REG_UPS_SHUTDOWN_VOLTAGE, value, verify)
 
-    def set_bat_v_coefficient(self, value):
-        return self.set_16bit_value(self.REG_BAT_V_COEFFICIENT, value)
+    def set_bat_v_coefficient(self, value, verify=False):
+        return self.set_16bit_value(self.REG_BAT_V_COEFFICIENT, value, verify)
 
-    def set_bat_v_constant(self, value):
-        return self.set_16bit_value(self.REG_BAT_V_CONSTANT, value)
+    def set_bat_v_constant(self, value, verify=False):
+        return self.set_16bit_value(self.REG_BAT_V_CONSTANT, value, verify)
 
-    def set_t_coefficient(self, value):
-        return self.set_16bit_value(self.REG_T_COEFFICIENT, value)
+    def set_t_coefficient(self, value, verify=False):
+        return self.set_16bit_value(self.REG_T_COEFFICIENT, value, verify)
 
-    def set_t_constant(self, value):
-        return self.set_16bit_value(self.REG_T_CONSTANT, value)
+    def set_t_constant(self, value, verify=False):
+        return self.set_16bit_value(self.REG_T_CONSTANT, value, verify)
 
-    def set_ext_v_coefficient(self, value):
-        return self.set_16bit_value(self.REG_EXT_V_COEFFICIENT, value)
+    def set_ext_v_coefficient(self, value, verify=False):
+        return self.set_16bit_value(self.REG_EXT_V_COEFFICIENT, value, verify)
 
-    def set_ext_v_constant(self, value):
-        return self.set_16bit_value(self.REG_EXT_V_CONSTANT, value)
+    def set_ext_v_constant(self, value, verify=False):
+        return self.set_16bit_value(self.REG_EXT_V_CONSTANT, value, verify)
 
-    def set_pulse_length(self, value):
-        return self.set_16bit_value(self.REG_PULSE_LENGTH, value)
+    def set_pulse_length(self, value, verify=False):
+        return self.set_16bit_value(self.REG_PULSE_LENGTH, value, verify)
 
-    def set_switch_recovery_delay(self, value):
-        return self.set_16bit_value(self.REG_SW_RECOVERY_DELAY, value)
+    def set_switch_recovery_delay(self, value, verify=False):
+        return self.set_16bit_value(self.REG_SW_RECOVERY_DELAY, value, verify)
 
-    def set_pulse_length_on(self, value):
-        return self.set_16bit_value(self.REG_PULSE_LENGTH_ON, value)
+    def set_pulse_length_on(self, value, verify=False):
+        return self.set_16bit_value(self.REG_PULSE_LENGTH_ON, value, verify)
 
-    def set_pulse_length_off(self, value):
-        return self.set_16bit_value(self.REG_PULSE_LENGTH_OFF, value)
+    def set_pulse_length_off(self, value, verify=False):
+        return self.set_16bit_value(self.REG_PULSE_LENGTH_OFF, value, verify)
 
-    def set_16bit_value(self, register, value):
+    def set_16bit_value(self, register, value, verify=False):
         # we interpret every value as a 16-bit signed value
-        vals = value.to_bytes(2, byteorder='little', signed=True)
+        vals = struct.pack('<h', value)
         crc = self.calcCRC(register, vals, 2)
 
         arg_list = [vals[0], vals[1], crc]
 
+        self._cache.pop(register, None)
         for x in range(self._num_retries):
-            bus = smbus.SMBus(self._bus_number)
-            time.sleep(self._time_const)
+            bus = self._open_bus()
             try:
-                bus.write_i2c_block_data(self._address, register, arg_list)
-                bus.close()
-                if (self.get_16bit_value(register)) == value:
-                    return True
+                # the ATTiny silently drops writes with a wrong CRC, only a read-back tells us
+                if verify and i2c_msg is not None:
+                    read = self._write_read(bus, register, arg_list, 3)
+                    if read[2] == self.calcCRC(register, read, 2) and read[0:2] == arg_list[0:2]:
+                        self._store(register, value)
+                        return True
+                    logging.debug("Couldn't verify 16 bit register %#x.", register)
+                else:
+                    bus.write_i2c_block_data(self._address, register, arg_list)
+                    if not verify or self.get_16bit_value(register) == value:
+                        return True
             except Exception as e:
-                logging.debug("Couldn't set 16 bit register " + hex(register) + ". Exception: " + str(e))
-        logging.warning("Couldn't set 16 bit register after " + str(x) + " retries.")
+                self.close()  # reopen the bus with the next attempt
+                logging.debug("Couldn't set 16 bit register %#x. Exception: %s", register, e)
+                if self._is_permanent(e):
+                    break
+            self._backoff(x, 4)
+        logging.warning("Couldn't set 16 bit register after %s retries.", x)
         return False
 
     def get_last_access(self):
@@ -218,22 +323,36 @@ class ATTiny:
         return self.get_16bit_value(self.REG_PULSE_LENGTH_OFF)
 
     def get_16bit_value(self, register):
+        val = self._cached(register)
+        if val is not None:
+            return val
+
+        table = self._CRC_TABLE
         for x in range(self._num_retries):
-            bus = smbus.SMBus(self._bus_number)
-            time.sleep(self._time_const)
+            bus = self._open_bus()
             try:
-                read = bus.read_i2c_block_data(self._address, register, 3)
-                # we interpret every value as a 16-bit signed value
-                val = int.from_bytes(read[0:2], byteorder='little', signed=True)
-                bus.close()
-                if read[2] == self.calcCRC(register, read, 2):
+                (low, high, crc) = bus.read_i2c_block_data(self._address, register, 3)
+                # check the CRC inline, the value is only decoded if it is correct
+                if crc == table[table[table[register] ^ low] ^ high]:
+                    # we interpret every value as a 16-bit signed value
+                    (val,) = struct.unpack('<h', bytes((low, high)))
+                    self._store(register, val)
                     return val
-                logging.debug("Couldn't read 16 bit register " + hex(register) + " correctly.")
+                logging.debug("Couldn't read 16 bit register %#x correctly.", register)
             except Exception as e:
-                logging.debug("Couldn't read 16 bit register " + hex(register) + ". Exception: " + str(e))
-        logging.warning("Couldn't read 16 bit register after " + str(x) + " retries.")
+                self.close()  # reopen the bus with the next attempt
+                logging.debug("Couldn't read 16 bit register %#x. Exception: %s", register, e)
+                if self._is_permanent(e):
+                    break
+            self._backoff(x, 4)
+        logging.warning("Couldn't read 16 bit register after %s retries.", x)
         return 0xFFFFFFFF
 
+    def get_16bit_values(self, registers):
+        # the firmware answers each read with exactly one register, so
+        # the batch is a sequence of reads over the already open bus
+        return {register: self.get_16bit_value(register) for register in registers}
+
     def get_timeout(self):
         return self.get_8bit_value(self.REG_TIMEOUT)
 
@@ -271,52 +390,99 @@ class ATTiny:
         return self.get_8bit_value(self.REG_MCU_STATUS_REG)
 
     def get_8bit_value(self, register):
+        val = self._cached(register)
+        if val is not None:
+            return val
+
+        table = self._CRC_TABLE
         for x in range(self._num_retries):
-            bus = smbus.SMBus(self._bus_number)
-            time.sleep(self._time_const)
+            bus = self._open_bus()
             try:
-                read = bus.read_i2c_block_data(self._address, register, 2)
-                val = read[0]
-                bus.close()
-                if read[1] == self.calcCRC(register, read, 1):
+                (val, crc) = bus.read_i2c_block_data(self._address, register, 2)
+                if crc == table[table[register] ^ val]:
+                    if register in self._CACHE_TTLS:
+                        self._store(register, val)
                     return val
-                logging.debug("Couldn't read register " + hex(register) + " correctly: " + hex(val))
+                logging.debug("Couldn't read register %#x correctly: %#x", register, val)
             except Exception as e:
-                logging.debug("Couldn't read 8 bit register " + hex(register) + ". Exception: " + str(e))
-        logging.warning("Couldn't read 8 bit register after " + str(x) + " retries.")
+                self.close()  # reopen the bus with the next attempt
+                logging.debug("Couldn't read 8 bit register %#x. Exception: %s", register, e)
+                if self._is_permanent(e):
+                    break
+            self._backoff(x, 3)
+        logging.warning("Couldn't read 8 bit register after %s retries.", x)
         return 0xFFFF
 
     def get_version(self):
+        version = self._cached(self.REG_VERSION)
+        if version is not None:
+            return version
+
         for x in range(self._num_retries):
-            bus = smbus.SMBus(self._bus_number)
-            time.sleep(self._time_const)
+            bus = self._open_bus()
             try:
                 read = bus.read_i2c_block_data(self._address, self.REG_VERSION, 5)
-                bus.close()
                 if read[4] == self.calcCRC(self.REG_VERSION, read, 4):
                     major = read[2]
                     minor = read[1]
                     patch = read[0]
+                    self._store(self.REG_VERSION, (major, minor, patch))
                     return (major, minor, patch)
                 logging.debug("Couldn't read version information correctly.")
             except Exception as e:
-                logging.debug("Couldn't read version information. Exception: " + str(e))
-        logging.warning("Couldn't read version information after " + str(x) + " retries.")
+                self.close()  # reopen the bus with the next attempt
+                logging.debug("Couldn't read version information. Exception: %s", e)
+                if self._is_permanent(e):
+                    break
+            self._backoff(x, 6)
+        logging.warning("Couldn't read version information after %s retries.", x)
         return (0xFFFF, 0xFFFF, 0xFFFF)
 
     def get_uptime(self):
         for x in range(self._num_retries):
-            bus = smbus.SMBus(self._bus_number)
-            time.sleep(self._time_const)
+            bus = self._open_bus()
             try:
                 read = bus.read_i2c_block_data(self._address, self.REG_UPTIME, 5)
-                bus.close()
                 if read[4] == self.calcCRC(self.REG_UPTIME, read, 4):
                     uptime = int.from_bytes(read[0:3], byteorder='little', signed=False)
                     return uptime
                 logging.debug("Couldn't read uptime information correctly.")
             except Exception as e:
-                logging.debug("Couldn't read uptime information. Exception: " + str(e))
-        logging.warning("Couldn't read uptime information after " + str(x) + " retries.")
+                self.close()  # reopen the bus with the next attempt
+                logging.debug("Couldn't read uptime information. Exception: %s", e)
+                if self._is_permanent(e):
+                    break
+            self._backoff(x, 6)
+        logging.warning("Couldn't read uptime information after %s retries.", x)
         return 0xFFFFFFFFFFFF
 
+    def get_status_block(self):
+        # should_shutdown, last_access, bat_voltage, ext_voltage and temperature
+        # in a single transfer, needs firmware version 2.13.16 or later
+        for x in range(self._num_retries):
+            bus = self._open_bus()
+            try:
+                read = bus.read_i2c_block_data(self._address, self.REG_STATUS, 10)
+                if read[9] == self.calcCRC(self.REG_STATUS, read, 9):
+                    # we interpret every 16 bit value as a signed value
+                    return struct.unpack_from('<Bhhhh', bytes(read))
+                logging.debug("Couldn't read status information correctly.")
+            except Exception as e:
+                self.close()  # reopen the bus with the next attempt
+                logging.debug("Couldn't read status information. Exception: %s", e)
+                if self._is_permanent(e):
+                    break
+            self._backoff(x, 11)
+        logging.warning("Couldn't read status information after %s retries.", x)
+        return (0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF)
+
+    def refresh(self):
+        # a snapshot of the values the ATTiny measures, read in one transfer
+        # if the firmware has the status register
+        if self.get_version() >= self.STATUS_BLOCK_VERSION:
+            values = self.get_status_block()
+        else:
+            values = (self.should_shutdown(),) + tuple(self.get_16bit_values(
+                (self.REG_LAST_ACCESS, self.REG_BAT_VOLTAGE,
+                 self.REG_EXT_VOLTAGE, self.REG_TEMPERATURE)).values())
+        return dict(zip(self.STATUS_NAMES, values))
@@ -5,11 +5,10 @@ import sys
 sys.path.append('/opt/attiny_daemon/')  # add the path to our ATTiny module
 
 import time
-import smbus
 import logging
 from attiny_i2c import ATTiny
 
-_time_const = 1.0   # used as a pause between i2c communications, the ATTiny is slow
+_time_const = 1.0   # maximum back-off between i2c retries, the ATTiny is slow
 _num_retries = 10   # the number of retries when reading from or writing to the ATTiny_Daemon
 _i2c_address = 0x37 # the I2C address that is used for the ATTiny_Daemon
 
@@ -32,14 +31,17 @@ states = {
 }
 
 state = attiny.get_internal_state()
-logging.info("Current state is " + hex(state) + ": " + states[state])
-logging.info("Current should_shutdown value is " + hex(attiny.should_shutdown()))
+status = attiny.refresh()
+logging.info("Current state is %#x: %s", state, states[state])
+logging.info("Current should_shutdown value is %#x", status["should_shutdown"])
 
 # access data
-logging.info("Current battery voltage is " + str(attiny.get_bat_voltage() / 1000) + "V.")
-logging.info("Current external voltage is " + str(attiny.get_ext_voltage() / 1000) + "V.")
-
-logging.info("Current warn voltage is " + str(attiny.get_warn_voltage() / 1000) + "V.")
-logging.info("Current ups shutdown voltage is " + str(attiny.get_ups_shutdown_voltage() / 1000) + "V.")
-logging.info("Current restart voltage is " + str(attiny.get_restart_voltage() / 1000) + "V.")
-
+logging.info("Current battery voltage is %sV.", status["battery_voltage"] / 1000)
+logging.info("Current external voltage is %sV.", status["external_voltage"] / 1000)
+
+# the ATTiny answers each read with a single register
+voltages = attiny.get_16bit_values((attiny.REG_WARN_VOLTAGE, attiny.REG_UPS_SHUTDOWN_VOLTAGE,
+                                    attiny.REG_RESTART_VOLTAGE))
+logging.info("Current warn voltage is %sV.", voltages[attiny.REG_WARN_VOLTAGE] / 1000)
+logging.info("Current ups shutdown voltage is %sV.", voltages[attiny.REG_UPS_SHUTDOWN_VOLTAGE] / 1000)
+logging.info("Current restart voltage is %sV.", voltages[attiny.REG_RESTART_VOLTAGE] / 1000)
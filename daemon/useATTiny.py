@@ -8,7 +8,7 @@ import time
 import logging
 from attiny_i2c import ATTiny
 
-_time_const  = 1.0  # used as a pause between i2c communications, the ATTiny is slow
+_time_const  = 1.0  # maximum back-off between i2c retries, the ATTiny is slow
 _num_retries = 10   # the number of retries when reading from or writing to the ATTiny_Daemon
 _i2c_address = 0x37 # the I2C address that is used for the ATTiny_Daemon
 
@@ -22,32 +22,31 @@ attiny = ATTiny(bus, _i2c_address, _time_const, _num_retries)
 
 # access data
 (major, minor, patch) = attiny.get_version()
-version = str(major) + "." + str(minor) + "." + str(patch)
-logging.info("Current Version is " + version)
+logging.info("Current Version is %s.%s.%s", major, minor, patch)
 
-logging.info("Uptime is " + str(attiny.get_uptime()))
+logging.info("Uptime is %s", attiny.get_uptime())
 
-logging.info("Current temperature is " + str(attiny.get_temperature()) + " degrees Celsius.")
+logging.info("Current temperature is %s degrees Celsius.", attiny.get_temperature())
 
-logging.info("Current battery voltage is " + str(attiny.get_bat_voltage() / 1000) + "V.")
-logging.info("Current external voltage is " + str(attiny.get_ext_voltage() / 1000) + "V.")
+logging.info("Current battery voltage is %sV.", attiny.get_bat_voltage() / 1000)
+logging.info("Current external voltage is %sV.", attiny.get_ext_voltage() / 1000)
 
-logging.info("Current timeout is " + str(attiny.get_timeout()))
-logging.info("Current primed is " + str(attiny.get_primed()))
-logging.info("Current force_shutdown is " + str(attiny.get_force_shutdown()))
+logging.info("Current timeout is %s", attiny.get_timeout())
+logging.info("Current primed is %s", attiny.get_primed())
+logging.info("Current force_shutdown is %s", attiny.get_force_shutdown())
 
-logging.info("Current warn voltage is " + str(attiny.get_warn_voltage() / 1000) + "V.")
-logging.info("Current ups shutdown voltage is " + str(attiny.get_ups_shutdown_voltage() / 1000) + "V.")
-logging.info("Current restart voltage is " + str(attiny.get_restart_voltage() / 1000) + "V.")
+logging.info("Current warn voltage is %sV.", attiny.get_warn_voltage() / 1000)
+logging.info("Current ups shutdown voltage is %sV.", attiny.get_ups_shutdown_voltage() / 1000)
+logging.info("Current restart voltage is %sV.", attiny.get_restart_voltage() / 1000)
 
-logging.info("Current ups configuration is " + hex(attiny.get_ups_configuration()))
-logging.info("Current pulse length is " + str(attiny.get_pulse_length()))
-logging.info("Current pulse length on is " + str(attiny.get_pulse_length_on()))
-logging.info("Current pulse length off is " + str(attiny.get_pulse_length_off()))
-logging.info("Current switch recovery delay is " + str(attiny.get_switch_recovery_delay()))
+logging.info("Current ups configuration is %#x", attiny.get_ups_configuration())
+logging.info("Current pulse length is %s", attiny.get_pulse_length())
+logging.info("Current pulse length on is %s", attiny.get_pulse_length_on())
+logging.info("Current pulse length off is %s", attiny.get_pulse_length_off())
+logging.info("Current switch recovery delay is %s", attiny.get_switch_recovery_delay())
 
-logging.info("Current led off mode is " + str(attiny.get_led_off_mode()))
+logging.info("Current led off mode is %s", attiny.get_led_off_mode())
 
-logging.info("Low fuse is " + hex(attiny.get_fuse_low()))
-logging.info("High fuse is " + hex(attiny.get_fuse_high()))
-logging.info("Extended fuse is " + hex(attiny.get_fuse_extended()))
+logging.info("Low fuse is %#x", attiny.get_fuse_low())
+logging.info("High fuse is %#x", attiny.get_fuse_high())
+logging.info("Extended fuse is %#x", attiny.get_fuse_extended())
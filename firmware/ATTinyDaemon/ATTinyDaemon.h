@@ -19,7 +19,7 @@
 */
 static const uint32_t MAJOR = 2;
 static const uint32_t MINOR = 13;
-static const uint32_t PATCH = 15;
+static const uint32_t PATCH = 16;
 
 /*
    Flash size definition
@@ -168,10 +168,23 @@ enum class Register : uint8_t {
   internal_state                = 0x84,
   uptime                        = 0x85,
   mcu_status_register           = 0x86,
+  status                        = 0x87,
 
   init_eeprom                   = 0xFF,
 }; // __attribute__ ((__packed__));            // force smallest size i.e., uint_8t (GCC syntax)
 
+/*
+   The content of the status register. It combines the values the RPi polls
+   most often, allowing it to read them with a single transfer.
+*/
+struct Status {
+  uint8_t  should_shutdown;
+  uint16_t seconds;
+  uint16_t bat_voltage;
+  uint16_t ext_voltage;
+  uint16_t temperature;
+} __attribute__ ((__packed__));
+
 
 /*
    The shutdown levels
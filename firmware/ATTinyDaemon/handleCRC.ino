@@ -1,8 +1,10 @@
 /*
    These method calculate an 8-bit CRC based on the polynome used for Dallas / Maxim
    sensors (X^8+X^5+X^4+X^0).
-   A lot of implementations exist that are equally good. I took this one from
-   https://www.mikrocontroller.net/topic/155115
+   A lot of implementations exist that are equally good. This one processes a
+   nibble at a time using a table of 16 bytes in flash, which is about four
+   times faster than shifting bit by bit and keeps the time spent in the I2C
+   interrupt short.
    The variables here don't need to be volatile because they are only accessed
    during the interrupt in the I2C callback routines.
 
@@ -12,25 +14,23 @@
 const uint8_t CRC8INIT = 0x00;                         // The initalization value used for the CRC calculation
 const uint8_t CRC8POLY = 0x31;                         // The CRC8 polynome used: X^8+X^5+X^4+X^0
 
+/*
+   The CRC of the values 0x00, 0x10, ... 0xF0 for CRC8POLY, indexed by the upper nibble.
+*/
+const uint8_t crc8_nibble_table[16] PROGMEM = {
+  0x00, 0x31, 0x62, 0x53, 0xc4, 0xf5, 0xa6, 0x97,
+  0xb9, 0x88, 0xdb, 0xea, 0x7d, 0x4c, 0x1f, 0x2e
+};
+
 /*
    This function adds the current byte of data to the existing CRC calculation in the
    variable reg.
 */
 unsigned char crc8_bytecalc(uint8_t data, uint8_t reg)
 {
-  uint8_t i;                                           // we assume we have less than 255 bytes data
-  uint8_t flag;                                        // flag for the MSB
-  uint8_t polynome = CRC8POLY;
-
-  // for each bit of the byte
-  for (i = 0; i < 8; i++) {
-    if (reg & 0x80) flag = 1;                          // Test MSB of the register
-    else flag = 0;
-    reg <<= 1;                                         // Schiebe Register 1 Bit nach Links und
-    if (data & 0x80) reg |= 1;                         // Fill the LSB with the next data bit
-    data <<= 1;                                        // next bit of data
-    if (flag) reg ^= polynome;                         // if flag == 1 (MSB set) then XOR with polynome
-  }
+  reg ^= data;
+  reg = (uint8_t)(reg << 4) ^ pgm_read_byte(&crc8_nibble_table[reg >> 4]);  // upper nibble
+  reg = (uint8_t)(reg << 4) ^ pgm_read_byte(&crc8_nibble_table[reg >> 4]);  // lower nibble
   return reg;
 }
 
@@ -45,7 +45,7 @@ unsigned char crc8_message_calc(uint8_t *msg, uint8_t len)
   for (i = 0; i < len; i++) {
     reg = crc8_bytecalc(msg[i], reg);      // calculate the CRC for the next byte of data and add it to reg
   }
-  return crc8_bytecalc(0, reg);      // The calculation has to be continued for the bit length of the polynome with 0 values
+  return reg;
 }
 
 /*
@@ -61,8 +61,7 @@ void write_data_crc(uint8_t *msg, uint8_t len) {
   for (i = 0; i < len; i++) {
     reg = crc8_bytecalc(msg[i], reg);
   }
-  uint8_t crc = crc8_bytecalc(0, reg);
 
   Wire.write(msg, len);
-  Wire.write(&crc, 1);
+  Wire.write(&reg, 1);
 }
@@ -284,6 +284,11 @@ void request_event() {
     case Register::mcu_status_register:
       write_data_crc((uint8_t *)&mcusr_mirror, sizeof(mcusr_mirror));
       break;
+    case Register::status: {
+      Status status = { should_shutdown, seconds, bat_voltage, ext_voltage, temperature };
+      write_data_crc((uint8_t *)&status, sizeof(status));
+      break;
+    }
   }
 
   // we had a read operation and reset the counter